@@ -1,14 +1,16 @@
 import sys
 import os
-import time
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QComboBox, QPushButton, QVBoxLayout, QWidget, QLabel, QTextEdit, QHBoxLayout, 
                              QMenuBar, QAction, QDialog, QFormLayout, QLineEdit, QPushButton as QDialogButton)
 from PyQt5.QtCore import QThread, pyqtSignal, QObject, Qt, QPoint, QTimer
 from PyQt5.QtGui import QPainter, QColor
-import sounddevice as sd
-from scipy import signal
 import numpy as np
+from numba import njit
+
+# sounddevice initialises PortAudio, which enumerates every host API, as soon as it is imported.
+# DeviceQueryThread imports it off the GUI thread and sets this module-level name
+sd = None
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -20,65 +22,163 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+@njit(cache=True, fastmath=True, nogil=True)
+def goertzel_powers(x, coeffs, powers):
+    """ Write the Goertzel power of the block x at every frequency coefficient into powers """
+    for k in range(coeffs.shape[0]):
+        c = coeffs[k]
+        # Single precision accumulators, so numba does not promote the whole recurrence to float64
+        s1 = np.float32(0.0)
+        s2 = np.float32(0.0)
+        for n in range(x.shape[0]):
+            s = x[n] + c * s1 - s2
+            s2 = s1
+            s1 = s
+        powers[k] = s1 * s1 + s2 * s2 - c * s1 * s2
+
+@njit(cache=True, nogil=True)
+def second_largest(values):
+    """ Second largest entry of values, without allocating a sorted copy """
+    first = values[0]
+    second = -np.inf
+    for k in range(1, values.shape[0]):
+        if values[k] > first:
+            second = first
+            first = values[k]
+        elif values[k] > second:
+            second = values[k]
+    return second
+
+def warm_up_kernels():
+    """ Compile the numba kernels, or load them from the cache, with the argument types the detector uses """
+    powers = np.empty(8, dtype=np.float32)
+    goertzel_powers(np.zeros(16, dtype=np.float32), np.zeros(8, dtype=np.float32), powers)
+    second_largest(powers[:4])
+
 class DTMFDetector(QObject):
     dtmf_detected = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, sample_rate=44100):
         super().__init__()
-        self.dtmf_freqs = {
-            '1': (697, 1209), '2': (697, 1336), '3': (697, 1477), 'A': (697, 1633),
-            '4': (770, 1209), '5': (770, 1336), '6': (770, 1477), 'B': (770, 1633),
-            '7': (852, 1209), '8': (852, 1336), '9': (852, 1477), 'C': (852, 1633),
-            '*': (941, 1209), '0': (941, 1336), '#': (941, 1477), 'D': (941, 1633)
-        }
-        self.delay = 0.2  # Default delay in seconds
-        self.last_detection_time = time.time()
-        self.detection_queue = []
-
-    def detect_dtmf(self, audio_data):
-        self.detection_queue.append(audio_data)
-
-    def process_queue(self):
-        current_time = time.time()
-        if current_time - self.last_detection_time >= self.delay and self.detection_queue:
-            audio_data = self.detection_queue.pop(0)
-            self.detect_from_data(audio_data)
-            self.last_detection_time = current_time
+        # DTMF keypad as parallel arrays: the row picks the low tone and the column the high tone
+        self.low_freqs = np.array([697, 770, 852, 941], dtype=np.float32)
+        self.high_freqs = np.array([1209, 1336, 1477, 1633], dtype=np.float32)
+        self.key_grid = np.array([['1', '2', '3', 'A'],
+                                  ['4', '5', '6', 'B'],
+                                  ['7', '8', '9', 'C'],
+                                  ['*', '0', '#', 'D']])
+        # Goertzel filters over a 20 ms frame are ~50 Hz wide, wide enough to accept tones up to
+        # 1.5% off their nominal frequency while still rejecting 3.5% deviations
+        self.frame_duration = 0.02
+        self.hop_duration = 0.01  # Frames overlap by half, so no part of a block goes unanalysed
+        self.min_duration = 0.04  # Shortest tone, in seconds, that is reported as a key press
+        self.set_context(sample_rate)
+        self.powers = np.empty(8, dtype=np.float32)  # Reused output of the Goertzel kernel
+        self.silence_threshold = 1e-4  # Mean square level (-40 dBFS) below which a frame is treated as silence
+        self.energy_ratio = 0.4  # Share of the frame energy both tones must carry together
+        self.dominance = 4  # Power ratio between the strongest and the next tone in a group
+        self.min_twist = 0.158  # -8 dB low/high power ratio
+        self.max_twist = 6.31  # +8 dB low/high power ratio
+        self.delay = 0  # Minimum gap in seconds after a reported press before the next one is reported
+
+    def set_context(self, sample_rate):
+        # Called for every new stream: recomputes the per-rate constants and drops any carried-over audio
+        # Goertzel coefficients for the 4 low-group tones followed by the 4 high-group tones
+        tones = np.concatenate((self.low_freqs, self.high_freqs))
+        self.coeffs = (2 * np.cos(2 * np.pi * tones / sample_rate)).astype(np.float32)
+        self.frame_size = int(round(sample_rate * self.frame_duration))
+        self.sample_rate = sample_rate
+        self.hop_size = int(round(sample_rate * self.hop_duration))
+        # Consecutive frames a key must hold before it is reported. Each frame adds one hop of signal and
+        # frames only partly covered by the tone still pass, so this many hops matches min_duration
+        self.min_frames = max(1, int(round(self.min_duration * sample_rate / self.hop_size)))
+        # Samples carried over between blocks until a full frame is available
+        self.samples = np.zeros(2 * self.frame_size, dtype=np.float32)
+        self.sample_count = 0
+        self.candidate = None
+        self.confirmed_frames = 0
+        self.reported = False
+        # Frame clock in stream time, so the delay does not depend on when blocks are processed
+        self.frame_index = 0
+        self.press_end_frame = None
 
     def detect_from_data(self, audio_data):
-        if len(audio_data) == 0:
+        block = audio_data[:, 0]
+        sample_count = self.sample_count + len(block)
+        if sample_count > len(self.samples):
+            # A larger block than before; grow the carry-over buffer once
+            samples = np.zeros(sample_count, dtype=np.float32)
+            samples[:self.sample_count] = self.samples[:self.sample_count]
+            self.samples = samples
+        self.samples[self.sample_count:sample_count] = block
+        self.sample_count = sample_count
+
+        # Analyse every full frame a hop apart and keep the tail for the next block
+        start = 0
+        while start + self.frame_size <= self.sample_count:
+            self.process_frame(self.classify_frame(self.samples[start:start + self.frame_size]))
+            start += self.hop_size
+        remaining = self.sample_count - start
+        self.samples[:remaining] = self.samples[start:self.sample_count]
+        self.sample_count = remaining
+
+    def process_frame(self, key):
+        self.frame_index += 1
+        if key != self.candidate:
+            # A different tone pair, or silence, restarts the confirmation count
+            if self.reported:
+                self.press_end_frame = self.frame_index
+            self.candidate = key
+            self.confirmed_frames = 0
+            self.reported = False
+        if key is None or self.reported:
             return
 
-        fft = np.fft.rfft(audio_data[:, 0])
-        freq = np.fft.rfftfreq(len(audio_data), d=1/44100)
-        magnitudes = np.abs(fft)
-
-        peak_height = np.max(magnitudes) * 0.68
-        peaks, _ = signal.find_peaks(magnitudes, height=peak_height, distance=2)
-        detected_freqs = freq[peaks][magnitudes[peaks] > 13]
-
-        valid_range = (600, 1700)
-        detected_freqs = detected_freqs[(detected_freqs >= valid_range[0]) & (detected_freqs <= valid_range[1])]
-
-        if len(detected_freqs) < 2:
+        # Report a key once per press, after it has held for min_frames consecutive frames
+        self.confirmed_frames += 1
+        if self.confirmed_frames < self.min_frames:
             return
-
-        detected_freqs = sorted(detected_freqs)
-        possible_pairs = []
-        for i in range(len(detected_freqs) - 1):
-            possible_pairs.append((detected_freqs[i], detected_freqs[i + 1]))
-
-        best_match = None
-        min_distance = float('inf')
-        for key, (low_freq, high_freq) in self.dtmf_freqs.items():
-            for pair in possible_pairs:
-                distance = abs(pair[0] - low_freq) + abs(pair[1] - high_freq)
-                if distance < min_distance:
-                    min_distance = distance
-                    best_match = key
-
-        if best_match:
-            self.dtmf_detected.emit(best_match)
+        if self.press_end_frame is not None:
+            # The latch already stops repeats; the delay only enforces a gap after the previous press
+            gap = (self.frame_index - self.press_end_frame) * self.hop_size
+            if gap < self.delay * self.sample_rate:
+                return
+        self.reported = True
+        self.dtmf_detected.emit(key)
+
+    def classify_frame(self, x):
+        # Returns the key whose tone pair passes the energy, single-tone and twist checks, or None
+        energy = np.dot(x, x)
+        if energy < self.silence_threshold * len(x):
+            # Silence between key presses; skip the filter bank altogether
+            return None
+
+        powers = self.powers
+        goertzel_powers(x, self.coeffs, powers)
+        low_powers = powers[:4]
+        high_powers = powers[4:]
+        low = np.argmax(low_powers)
+        high = np.argmax(high_powers)
+        low_power = low_powers[low]
+        high_power = high_powers[high]
+
+        # A pure tone of amplitude A has a Goertzel power of (A*N/2)^2 and a frame energy of A^2*N/2,
+        # so this ratio is 1 when the frame holds nothing but the two tones
+        tone_ratio = 2 * (low_power + high_power) / (len(x) * energy)
+        if tone_ratio < self.energy_ratio:
+            return None
+
+        # Exactly one strong tone in each group
+        if low_power < self.dominance * second_largest(low_powers):
+            return None
+        if high_power < self.dominance * second_largest(high_powers):
+            return None
+
+        # Twist: the two tones must be within 8 dB of each other
+        if not self.min_twist * high_power < low_power < self.max_twist * high_power:
+            return None
+
+        return str(self.key_grid[low, high])
 
 class AudioVisualizer(QWidget):
     def __init__(self, parent=None):
@@ -88,27 +188,39 @@ class AudioVisualizer(QWidget):
         self.color = QColor('#A594F9')  # Color for the meter
         self.setFixedWidth(50)  # Set a fixed width for the visualizer
         self.setMinimumHeight(200)  # Ensure the visualizer has a minimum height
-        self.smoothing_factor = 0.25  # Smoothing factor for the exponential moving average
+        self.full_scale = 0.07  # RMS level that fills the meter
+        self.repaint_interval = 33  # ~30 fps, in milliseconds
+        # Smoothing factor for the exponential moving average. The meter used to step once per
+        # 2048-sample block at 44.1 kHz with a factor of 0.25; rescale it to the repaint interval
+        # so the meter keeps the same response time
+        self.smoothing_factor = 1 - (1 - 0.25) ** ((self.repaint_interval / 1000) / (2048 / 44100))
+
+        # Repaint from the GUI thread at a fixed rate; the audio thread only stores the latest level
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.timeout.connect(self.smooth_level)
+        self.repaint_timer.start(self.repaint_interval)
 
     def update_bars(self, audio_data):
         if len(audio_data) == 0:
             # If no audio data, smoothly transition to 0
-            target_level = 0
-        else:
-            # Compute FFT and get magnitudes
-            fft = np.fft.rfft(audio_data[:, 0])
-            magnitudes = np.abs(fft)
-            
-            # Get the maximum magnitude and normalize for the visualizer
-            max_magnitude = np.max(magnitudes)
-            if max_magnitude == 0:  # Avoid division by zero
-                max_magnitude = 1
-            target_level = np.interp(max_magnitude, (0, 100), (0, self.height()))  # Scale the level
+            self.update_level(0)
+            return
+
+        # RMS of the block is all a level meter needs
+        x = audio_data[:, 0]
+        rms = float(np.sqrt(np.dot(x, x) / x.size))
+        self.update_level(np.interp(rms, (0, self.full_scale), (0, self.height())))  # Scale the level
+
+    def update_level(self, target_level):
+        self.level = target_level
 
+    def smooth_level(self):
+        previous_height = int(self.smoothed_level)
         # Apply exponential moving average for smoothing
-        self.smoothed_level = (self.smoothing_factor * target_level) + ((1 - self.smoothing_factor) * self.smoothed_level)
+        self.smoothed_level = (self.smoothing_factor * self.level) + ((1 - self.smoothing_factor) * self.smoothed_level)
 
-        self.update()  # Request a repaint
+        if int(self.smoothed_level) != previous_height:
+            self.update()  # Request a repaint
 
     def paintEvent(self, event):
         painter = QPainter(self)
@@ -120,7 +232,6 @@ class AudioVisualizer(QWidget):
         painter.drawRect(0, self.height() - height, bar_width, height)
 
 class AudioThread(QThread):
-    audio_data_signal = pyqtSignal(np.ndarray)
     dtmf_detected = pyqtSignal(str)
     
     def __init__(self, input_device, output_device, visualizer=None, main_window=None):
@@ -132,45 +243,92 @@ class AudioThread(QThread):
         self.running = False
         self.buffer_size = 2048
         self.sample_rate = 44100
-        self.detector = DTMFDetector()
+        self.reconfigure = False
+        self.detector = DTMFDetector(self.sample_rate)
         self.detector.dtmf_detected.connect(self.handle_dtmf_detected)
 
     def run(self):
         self.running = True
-        try:
-            with sd.Stream(device=(self.input_device, self.output_device),
-                           samplerate=self.sample_rate, 
-                           blocksize=self.buffer_size,
-                           channels=1, 
-                           callback=self.audio_callback):
-                while self.running:
-                    sd.sleep(100)
-                    self.detector.process_queue()
-        except sd.PortAudioError as e:
-            print(f"Audio error: {e}")
-
-    def audio_callback(self, indata, outdata, frames, time, status):
-        if status:
-            print(f"Status: {status}")
+        while self.running:
+            # Reopen the streams whenever the sample rate or buffer size is changed
+            self.reconfigure = False
+            self.detector.set_context(self.sample_rate)
+            self.silent = np.zeros((self.buffer_size, 1), dtype=np.float32)  # Written out while stopping
+            try:
+                with sd.InputStream(device=self.input_device,
+                                    samplerate=self.sample_rate,
+                                    blocksize=self.buffer_size,
+                                    channels=1,
+                                    dtype='float32') as input_stream, \
+                     sd.OutputStream(device=self.output_device,
+                                     samplerate=self.sample_rate,
+                                     blocksize=self.buffer_size,
+                                     channels=1,
+                                     dtype='float32') as output_stream:
+                    while self.running and not self.reconfigure:
+                        # Blocks until a full buffer is available; the returned array is ours to keep
+                        audio_data, overflowed = input_stream.read(self.buffer_size)
+                        if overflowed:
+                            print("Status: input overflow")
+                        self.process_block(audio_data, output_stream)
+            except sd.PortAudioError as e:
+                print(f"Audio error: {e}")
+                break
+
+    def process_block(self, audio_data, output_stream):
         if self.main_window and getattr(self.main_window, 'stop_transition', False):
             # Smooth transition to zero if stop_transition is True
-            self.visualizer.update_bars(np.zeros_like(indata))
-            outdata[:] = np.zeros_like(outdata)  # Ensure output is zero
+            self.visualizer.update_level(0)
+            output_stream.write(self.silent)  # Ensure output is zero
         else:
-            outdata[:] = indata
-            self.audio_data_signal.emit(indata)
+            output_stream.write(audio_data)
             if self.visualizer:
-                self.visualizer.update_bars(indata)
-            self.detector.detect_dtmf(indata)
+                self.visualizer.update_bars(audio_data)
+            self.detector.detect_from_data(audio_data)
 
     def handle_dtmf_detected(self, dtmf_char):
         self.dtmf_detected.emit(dtmf_char)
 
+    def set_sample_rate(self, sample_rate):
+        self.sample_rate = int(sample_rate)
+        self.reconfigure = True
+
+    def set_buffer_size(self, buffer_size):
+        self.buffer_size = int(buffer_size)
+        self.reconfigure = True
+
+    def set_delay(self, delay):
+        self.detector.delay = delay
+
     def stop(self):
         self.running = False  # Set running flag to False to stop the thread
         # Additional clean-up code if needed
         self.wait()  # Wait for the thread to finish execution
 
+class DeviceQueryThread(QThread):
+    devices_ready = pyqtSignal(object)
+
+    def __init__(self, rescan=False):
+        super().__init__()
+        self.rescan = rescan
+
+    def run(self):
+        global sd
+        try:
+            if sd is None:
+                import sounddevice as sd
+            elif self.rescan and hasattr(sd, '_terminate') and hasattr(sd, '_initialize'):
+                # PortAudio only builds its device list when it is initialised. sounddevice has no public
+                # way to re-initialise it, so use its internal helpers and keep the old list if they go away
+                sd._terminate()
+                sd._initialize()
+            devices = list(sd.query_devices())
+        except Exception as e:
+            # Missing PortAudio library or a failing host API; leave the lists empty rather than hang
+            print(f"Audio error: {e}")
+            devices = []
+        self.devices_ready.emit(devices)
+
 class SettingsDialog(QDialog):
     def __init__(self, title, setting_name, current_value, callback, parent=None):
         super().__init__(parent)
@@ -205,11 +363,6 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("rDTMF")
         self.setFixedSize(600, 400)
         self.stop_transition = False
-        
-        # Timer for smooth transition
-        self.transition_timer = QTimer()
-        self.transition_timer.timeout.connect(self.update_visualizer_transition)
-        self.transition_timer.start(75)  # Timer interval in milliseconds
 
         # Set the main window background color
         self.setStyleSheet("background-color: #051014;")
@@ -380,6 +533,10 @@ class MainWindow(QMainWindow):
         buffer_size_action.triggered.connect(self.show_buffer_size_dialog)
         options_menu.addAction(buffer_size_action)
 
+        self.refresh_devices_action = QAction("Refresh Devices", self)
+        self.refresh_devices_action.triggered.connect(lambda: self.refresh_devices(rescan=True))
+        options_menu.addAction(self.refresh_devices_action)
+
         # About Menu
         about_menu = self.menu_bar.addMenu("About")
         about_dtmf_action = QAction("About DTMF Decoder", self)
@@ -413,26 +570,53 @@ class MainWindow(QMainWindow):
         container.setLayout(main_layout)
         self.setCentralWidget(container)
 
-        self.populate_devices()
         self.start_button.clicked.connect(self.start_detection)
         self.stop_button.clicked.connect(self.stop_detection)
         self.stop_button.setEnabled(False)
         self.clear_button.clicked.connect(self.clear_dtmf_output)
 
         self.audio_thread = None
+
+        # Device list, filled in by a background query so the window can paint straight away
+        self.devices = []
+        self.device_thread = None
+        self.refresh_devices()
         
         # Flag to indicate stopping
         stop_transition = False
 
 
-    def populate_devices(self):
-        devices = sd.query_devices()
-        for device in devices:
+    def refresh_devices(self, rescan=False):
+        if self.device_thread and self.device_thread.isRunning():
+            return
+        # Re-initialising PortAudio is only safe with no stream open, which the disabled Start button
+        # and Refresh Devices action guarantee while this runs
+        self.start_button.setEnabled(False)
+        self.refresh_devices_action.setEnabled(False)
+        self.device_thread = DeviceQueryThread(rescan)
+        self.device_thread.devices_ready.connect(self.populate_devices)
+        self.device_thread.start()
+
+    def populate_devices(self, devices):
+        self.devices = devices
+        input_device = self.input_combo.currentData()
+        output_device = self.output_combo.currentData()
+        self.input_combo.clear()
+        self.output_combo.clear()
+        for device in self.devices:
             if device['max_input_channels'] > 0:
                 self.input_combo.addItem(f"{device['name']} (Input)", device['index'])
             if device['max_output_channels'] > 0:
                 self.output_combo.addItem(f"{device['name']} (Output)", device['index'])
 
+        # Keep the previous selection if the device is still there
+        for combo, device_index in ((self.input_combo, input_device), (self.output_combo, output_device)):
+            if device_index is not None and combo.findData(device_index) >= 0:
+                combo.setCurrentIndex(combo.findData(device_index))
+        # Without sounddevice there is nothing to start; Refresh Devices stays available to retry
+        self.start_button.setEnabled(sd is not None and not self.audio_thread)
+        self.refresh_devices_action.setEnabled(not self.audio_thread)
+
     def start_detection(self):
         input_device = self.input_combo.currentData()
         output_device = self.output_combo.currentData()
@@ -442,6 +626,8 @@ class MainWindow(QMainWindow):
         self.audio_thread.start()
         self.start_button.setEnabled(False)
         self.stop_button.setEnabled(True)
+        # Devices are only picked up when playback starts, so refreshing waits until it stops
+        self.refresh_devices_action.setEnabled(False)
         
         self.stop_transition = False  # Reset stop transition flag
 
@@ -450,14 +636,12 @@ class MainWindow(QMainWindow):
             self.stop_transition = True
             self.audio_thread.stop()  # Stop the audio thread
             self.audio_thread = None
+            # The meter's own timer smooths this down to zero
+            self.visualizer.update_level(0)
         self.start_button.setEnabled(True)
         self.stop_button.setEnabled(False)
+        self.refresh_devices_action.setEnabled(True)
         
-    def update_visualizer_transition(self):
-        if self.stop_transition and self.visualizer:
-            # Smooth transition to zero
-            self.visualizer.update_bars(np.zeros((self.visualizer.height(), 1)))
-
     def update_dtmf_label(self, dtmf_char):
         self.dtmf_output.append(dtmf_char)
         
@@ -476,7 +660,7 @@ class MainWindow(QMainWindow):
         if self.audio_thread:
             current_delay = self.audio_thread.detector.delay
         else:
-            current_delay = 0.2
+            current_delay = 0
         dialog = SettingsDialog("Timing (Delay)", "Delay (seconds)", current_delay, self.set_timing, self)
         dialog.exec_()
 
@@ -528,6 +712,8 @@ class MainWindow(QMainWindow):
         if self.audio_thread:
             self.audio_thread.stop()
             self.audio_thread.wait()
+        if self.device_thread:
+            self.device_thread.wait()
         event.accept()
 
 if __name__ == "__main__":
@@ -535,4 +721,7 @@ if __name__ == "__main__":
     app.setWindowIcon(QtGui.QIcon(resource_path('asset\\windico.png')))
     window = MainWindow()
     window.show()
+    # Compiling takes about a second on a fresh install and holds the GIL, so get it done once the
+    # window has painted rather than when the first audio block arrives
+    QTimer.singleShot(100, warm_up_kernels)
     sys.exit(app.exec_())